@@ -16,32 +16,107 @@
 
 
 from __future__ import annotations
-import json, os, sys, time, tempfile, subprocess, re
+import ast, json, os, sys, time, tempfile, subprocess, re, hashlib
+import contextlib, functools, io, signal, threading, traceback
 from pathlib import Path
-from typing import Any, Optional
+from types import CodeType
+from typing import Any, BinaryIO, Callable, Optional
 
 import requests
+try:
+    import orjson  # optional: faster (de)serialization
+except ImportError:
+    orjson = None
+try:
+    from openai import OpenAI  # optional: without it the agent runs in fallback mode
+except ImportError:
+    OpenAI = None
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 DOCS_URL = "https://developer.postnl.nl/docs/#/http/api-endpoints/send-track/shippingstatus/get-status-by-reference"
-ARTIFACTS = Path("artifacts")
+ARTIFACTS = Path("artifacts").resolve()  # absolute: generated code may chdir
 ARTIFACTS.mkdir(exist_ok=True)
+LLM_CACHE_DIR = ARTIFACTS / "llm_cache"  # exact-match cache of LLM replies, survives re-runs
+LLM_CACHE_DIR.mkdir(exist_ok=True)
+PROMPT_CACHE_KEY = "carrier-agent-v1"  # OpenAI prompt_cache_key for the codegen prefix
+_FENCE_RE = re.compile(r"(?s)^```(?:python)?\n|\n```$")
+_FENCED_BLOCK_RE = re.compile(r"(?s)```(?:python)?\n(.*?)\n```")
+
+# one pooled session for docs + in-process client runs (keep-alive across attempts)
+SESSION = requests.Session()
+# raise_on_status=False: after the last retry return the real 429/5xx response (status + body)
+# instead of a RetryError; Retry-After is ignored so one 429 can't eat the script's time budget
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                       max_retries=Retry(total=2, backoff_factor=0.2,
+                                         status_forcelist=(429, 500, 502, 503, 504),
+                                         raise_on_status=False,
+                                         respect_retry_after_header=False))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
 
 # ----- small utils -----
+def dumps(o: Any) -> bytes:
+    """Pretty UTF-8 JSON; orjson when installed, stdlib otherwise."""
+    if orjson is not None:
+        return orjson.dumps(o, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(o, ensure_ascii=False, indent=2).encode("utf-8")
+
+def dumps_line(o: Any) -> bytes:
+    """Compact one-line JSON plus newline, for .jsonl logs."""
+    if orjson is not None:
+        return orjson.dumps(o, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(o, ensure_ascii=False).encode("utf-8") + b"\n"
+
+def loads(s: str | bytes) -> Any:
+    return orjson.loads(s) if orjson is not None else json.loads(s)
+
+def save_bytes_atomic(p: Path, data: bytes) -> None:
+    """Write via a sibling temp file + os.replace, so readers never see a half-written file."""
+    tmp = p.with_suffix(p.suffix + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, p)
+
 def save_text(p: Path, s: str) -> None:
-    p.write_text(s, encoding="utf-8")
+    save_bytes_atomic(p, s.encode("utf-8"))
 
 def save_json(p: Path, o: Any) -> None:
-    p.write_text(json.dumps(o, ensure_ascii=False, indent=2), encoding="utf-8")
+    save_bytes_atomic(p, dumps(o))
+
+DOCS_CACHE = ARTIFACTS / "docs_cache.json"  # {url: {etag, last_modified, body_file}}
+
+def fetch_docs(url: str) -> bytes:
+    """Save docs HTML for audit; continue even if it fails. Returns the raw (undecoded) body.
 
-def fetch_docs(url: str) -> str:
-    """Save docs HTML for audit; continue even if it fails."""
+    Revalidates a cached copy with If-None-Match / If-Modified-Since, so an unchanged page costs a 304.
+    """
     try:
-        r = requests.get(url, headers={"User-Agent": "Carrier-Agent/1.0"}, timeout=30)
-        r.raise_for_status()
-        html = r.text
+        cache = loads(DOCS_CACHE.read_bytes())
+    except Exception:
+        cache = {}
+    entry = cache.get(url) or {}
+    body_file = ARTIFACTS / f"docs_{hashlib.blake2b(url.encode('utf-8'), digest_size=8).hexdigest()}.html.cache"
+    headers = {"User-Agent": "Carrier-Agent/1.0"}
+    if entry and body_file.exists():
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        r = SESSION.get(url, headers=headers, timeout=30)
+        if r.status_code == 304 and body_file.exists():
+            html = body_file.read_bytes()
+        else:
+            r.raise_for_status()
+            html = r.content
+            save_bytes_atomic(body_file, html)
+            cache[url] = {"etag": r.headers.get("ETag"),
+                          "last_modified": r.headers.get("Last-Modified"),
+                          "body_file": body_file.name}
+            save_json(DOCS_CACHE, cache)
     except Exception as e:
-        html = f"/* docs fetch error: {e} */"
-    save_text(ARTIFACTS / "docs.html", html)
+        html = body_file.read_bytes() if body_file.exists() else f"/* docs fetch error: {e} */".encode("utf-8")
+    save_bytes_atomic(ARTIFACTS / "docs.html", html)
     return html
 
 # ----- optional LLM wrapper -----
@@ -51,9 +126,8 @@ class LLM:
         self.model = model or os.getenv("LLM_MODEL", "gpt-4o-mini")
         self.client = None
         try:
-            from openai import OpenAI  # lazy import
             api_key = os.getenv("OPENAI_API_KEY") or os.getenv("OPENAI_APIKEY")
-            if api_key:
+            if OpenAI is not None and api_key:
                 self.client = OpenAI(api_key=api_key)
         except Exception:
             self.client = None
@@ -62,26 +136,67 @@ class LLM:
     def available(self) -> bool:
         return self.client is not None
 
-    def respond(self, prompt: str, temperature: float = 0.2, max_tokens: int = 1400) -> str:
-        """Return model text; on any error, record and return empty string."""
+    def respond(self, prompt: str, temperature: float = 0.2, max_tokens: int = 1400,
+                cache_key: Optional[str] = None,
+                stop: Optional[Callable[[str], bool]] = None,
+                text_format: Optional[dict] = None) -> tuple[str, bool]:
+        """Stream model text; on any error, record and return empty string.
+
+        Returns (text, complete). `complete` is True only when the response finished normally or
+        `stop` ended it; a reply cut off by max_output_tokens (or failed) must not be cached.
+        `cache_key` is sent as prompt_cache_key so calls sharing a prompt prefix hit the same cache.
+        `stop(text_so_far)` returning True ends the stream early (the rest is never generated);
+        it is only consulted when a delta contains '`' or '}', the characters that end a fence or object.
+        `text_format` is a Responses `text.format` object, e.g. a json_schema for structured output.
+        """
         if not self.available:
-            return ""
+            return "", False
+        kwargs: dict[str, Any] = {}
+        if text_format:
+            kwargs["text"] = {"format": text_format}
         try:
-            resp = self.client.responses.create(
+            text, complete = "", False
+            with self.client.responses.stream(
                 model=self.model,
                 input=prompt,
                 temperature=temperature,
                 max_output_tokens=max_tokens,
-            )
-            return getattr(resp, "output_text", "").strip()
+                extra_body={"prompt_cache_key": cache_key} if cache_key else None,
+                **kwargs,
+            ) as stream:
+                for event in stream:
+                    if event.type == "response.output_text.delta":
+                        delta = event.delta
+                        text += delta
+                        if stop is not None and ("`" in delta or "}" in delta) and stop(text):
+                            complete = True
+                            break  # leaving the block closes the stream
+                    elif event.type == "response.completed":
+                        complete = True
+                    elif event.type in ("response.incomplete", "response.failed"):
+                        complete = False
+            return text.strip(), complete
         except Exception as e:
             save_text(ARTIFACTS / "llm_error.txt", f"{type(e).__name__}: {e}")
-            return ""
+            return "", False
+
+@functools.lru_cache(maxsize=1)
+def get_llm(model: Optional[str] = None) -> LLM:
+    """Process-wide LLM, so codegen and judge share one client and its connection pool."""
+    return LLM(model)
 
 # ----- standalone client used as fallback -----
 FALLBACK_SCRIPT = r'''
 # Standalone client. Reads env and prints one JSON line.
 import json, time, os, sys, requests
+try:
+    import orjson as _oj  # optional: faster body parsing
+    _loads = _oj.loads
+except ImportError:
+    _loads = json.loads
+
+# the agent injects a pooled HTTP_SESSION when running in-process; standalone uses plain requests
+http = globals().get("HTTP_SESSION") or requests
 
 def main():
     base_url = os.getenv("POSTNL_BASE_URL", "https://api-sandbox.postnl.nl")
@@ -102,12 +217,12 @@ def main():
     }
     headers = {"Accept": "application/json", "apikey": apikey}
 
-    t0 = time.time()
+    t0 = time.perf_counter_ns()
     try:
-        r = requests.get(url, headers=headers, params=params, timeout=25)
-        raw = r.text
+        r = http.get(url, headers=headers, params=params, timeout=25)
+        raw_bytes = r.content  # decode once: parse bytes directly, text only for a non-JSON preview
         try:
-            body = r.json()
+            body = _loads(raw_bytes)
         except Exception:
             body = None  # not JSON
 
@@ -122,13 +237,13 @@ def main():
         out = {
             "http_status": r.status_code,
             "url": r.url,
-            "elapsed_ms": int((time.time() - t0)*1000),
+            "elapsed_ms": (time.perf_counter_ns() - t0) // 1_000_000,
             "status_code": derived_status,
             "result": body if isinstance(body, dict) else None,
             "content_type": r.headers.get("Content-Type"),
         }
         if body is None:
-            out["raw_preview"] = raw[:400]
+            out["raw_preview"] = raw_bytes[:1600].decode("utf-8", "replace")[:400]
         print(json.dumps(out, ensure_ascii=False))
         sys.exit(0)
     except Exception as e:
@@ -138,47 +253,218 @@ def main():
 if __name__ == "__main__":
     main()
 '''.strip()
+_FALLBACK_CODE = compile(FALLBACK_SCRIPT, "<fallback>", "exec")  # compiled once at import; only `except Exception`
 
 # ----- LLM codegen / judge (both optional with safe fallbacks) -----
-def llm_generate_script(docs_html: str, last_output: str = "") -> str:
-    """Ask LLM for a standalone client script; fall back to template on any issue."""
-    llm = LLM()
+def llm_cache_path(model: str, prompt: bytes, suffix: str, *extra: bytes) -> Path:
+    """Cache file for an exact (model, prompt, extra...) input; the caller decides what to store."""
+    h = hashlib.blake2b(model.encode("utf-8") + b"|", digest_size=16)
+    h.update(prompt)
+    for part in extra:
+        h.update(b"|")
+        h.update(part)
+    return LLM_CACHE_DIR / f"{h.hexdigest()}{suffix}"
+
+_SCRIPT_CACHE_FILES: dict[str, Path] = {}  # script source -> llm_cache entry it was served from / saved to
+
+def forget_cached_script(code: str) -> None:
+    """Drop the llm_cache entry behind a script that failed, so later runs don't replay it."""
+    p = _SCRIPT_CACHE_FILES.pop(code, None)
+    if p is not None:
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
+
+def as_prompt(*parts: bytes | memoryview) -> bytes:
+    """Join prompt pieces (zero-copy memoryview slices welcome) into one buffer."""
+    return b"".join(parts)
+
+def prompt_text(prompt: bytes) -> str:
+    # single decode at the LLM boundary; a byte-level cut may split a character, so drop partials
+    return prompt.decode("utf-8", "ignore")
+
+CODEGEN_PROMPT = (
+    "Write a single-file Python script that calls PostNL 'shipping status by reference'. "
+    "Read env vars: POSTNL_APIKEY, POSTNL_CUSTOMER_CODE, POSTNL_CUSTOMER_NUMBER, POSTNL_REFERENCE. "
+    "Default POSTNL_BASE_URL='https://api-sandbox.postnl.nl'. "
+    "Use GET with params: detail=true, language=NL, customerCode, customerNumber, maxDays=14. "
+    "Print exactly one JSON line: {http_status, status_code, result, url, elapsed_ms}. "
+    "On error print JSON with http_status=-1 and error. No extra prints. No code fences. "
+    "Make the GET via `globals().get('HTTP_SESSION') or requests` so a shared session is reused."
+)
+JUDGE_CRITERIA = "Success criteria: http_status==200 AND status_code==200. "
+_CODEGEN_PROMPT_B = CODEGEN_PROMPT.encode("utf-8")
+
+def codegen_prefix(docs_html: bytes) -> bytes:
+    # invariant docs + instructions first so provider-side prefix caching applies on retries
+    return as_prompt(b"Docs:\n", memoryview(docs_html)[:3000], b"\n\n", _CODEGEN_PROMPT_B)
+
+def strip_fences(code: str) -> str:
+    m = _FENCED_BLOCK_RE.search(code)
+    return (m.group(1) if m else _FENCE_RE.sub("", code)).strip()
+
+def llm_generate_script(docs_html: bytes, last_output: bytes = b"", last_script: str = "") -> str:
+    """Ask LLM for a standalone client script; fall back to template on any issue.
+
+    `last_script` (the script that printed `last_output`) only feeds the cache key.
+    """
+    llm = get_llm()
     if not llm.available:
         return FALLBACK_SCRIPT
-    sys_prompt = (
-        "Write a single-file Python script that calls PostNL 'shipping status by reference'. "
-        "Read env vars: POSTNL_APIKEY, POSTNL_CUSTOMER_CODE, POSTNL_CUSTOMER_NUMBER, POSTNL_REFERENCE. "
-        "Default POSTNL_BASE_URL='https://api-sandbox.postnl.nl'. "
-        "Use GET with params: detail=true, language=NL, customerCode, customerNumber, maxDays=14. "
-        "Print exactly one JSON line: {http_status, status_code, result, url, elapsed_ms}. "
-        "On error print JSON with http_status=-1 and error. No extra prints. No code fences."
-    )
-    user = "Docs:\n" + docs_html[:3000]
+    prompt = codegen_prefix(docs_html)
     if last_output:
-        user += "\n\nPrevious output to fix:\n" + last_output[:2000]
-    code = llm.respond(sys_prompt + "\n\n" + user, temperature=0.2)
-    code = re.sub(r"(?s)^```(?:python)?\n|\n```$", "", code).strip()
-    return code or FALLBACK_SCRIPT
-
-def llm_judge(output_text: str) -> dict:
-    """Try LLM-based verdict; fall back to an empty verdict on error."""
-    llm = LLM()
+        prompt = as_prompt(prompt, b"\n\nPrevious output to fix:\n", memoryview(last_output)[:2000])
+    cached = llm_cache_path(llm.model, prompt, ".py", last_script.encode("utf-8"))
+    if cached.exists():
+        code = cached.read_text(encoding="utf-8")
+        _SCRIPT_CACHE_FILES[code] = cached
+        return code
+    # models sometimes fence anyway; stop streaming once the fenced block is closed
+    code, complete = llm.respond(prompt_text(prompt), temperature=0.2, cache_key=PROMPT_CACHE_KEY,
+                                 stop=lambda t: "```" in t and _FENCED_BLOCK_RE.search(t) is not None)
+    code = strip_fences(code)
+    if not code:
+        return FALLBACK_SCRIPT  # don't cache failures
+    if complete:  # a truncated script is still worth one run, but never a cache entry
+        save_text(cached, code)
+        _SCRIPT_CACHE_FILES[code] = cached
+    return code
+
+_VERDICT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "success": {"type": "boolean"},
+        "reasons": {"type": "array", "items": {"type": "string"}},
+        "patch_hint": {"type": "string"},
+    },
+    "required": ["success", "reasons", "patch_hint"],
+    "additionalProperties": False,
+}
+_JUDGE_AND_FIX_PROMPT_B = (
+    "\n\nA script written to these instructions printed the output below. Judge it: "
+    + JUDGE_CRITERIA +
+    "If success is false, put a complete fixed script in next_script; otherwise leave it empty.\n"
+    "Output:\n"
+).encode("utf-8")
+_JUDGE_PROMPT_B = (
+    "Return JSON only with keys: "
+    '{"success": true|false, "reasons": [], "patch_hint": ""}. '
+    + JUDGE_CRITERIA +
+    "Output:\n"
+).encode("utf-8")
+JUDGE_AND_FIX_FORMAT = {
+    "type": "json_schema",
+    "name": "judge_and_fix",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {"verdict": _VERDICT_SCHEMA, "next_script": {"type": "string"}},
+        "required": ["verdict", "next_script"],
+        "additionalProperties": False,
+    },
+}
+
+def llm_judge_and_fix(docs_html: bytes, output: bytes, script: str = "") -> tuple[dict, str]:
+    """One LLM call that judges an attempt's output and, if it failed, writes the next script.
+
+    Returns (verdict, next_script); ({}, "") when the LLM is unavailable or the reply is unusable.
+    `script` (the one that printed `output`) only feeds the cache key.
+    """
+    llm = get_llm()
     if not llm.available:
-        return {}
-    prompt = (
-        "Return JSON only with keys: "
-        '{"success": true|false, "reasons": [], "patch_hint": ""}. '
-        "Success criteria: http_status==200 AND status_code==200. "
-        "Output:\n" + output_text[:2000]
+        return {}, ""
+    prompt = as_prompt(
+        codegen_prefix(docs_html),
+        _JUDGE_AND_FIX_PROMPT_B,
+        memoryview(output)[:2000],
     )
-    raw = llm.respond(prompt, temperature=0.0, max_tokens=500)
+    cached = llm_cache_path(llm.model, prompt, ".json", script.encode("utf-8"))
     try:
-        return json.loads(raw)
+        reply = loads(cached.read_bytes()) if cached.exists() else None
     except Exception:
+        reply = None  # corrupt entry; ask again
+    if not isinstance(reply, dict):
+        raw, complete = llm.respond(prompt_text(prompt), temperature=0.2, max_tokens=1900,
+                                    cache_key=PROMPT_CACHE_KEY,
+                                    stop=lambda t: t.rstrip().endswith("}") and json_object_complete(t),
+                                    text_format=JUDGE_AND_FIX_FORMAT)
+        try:
+            reply = loads(raw)  # structured output: the whole reply is one object
+        except Exception:
+            reply = parse_last_json_blob(raw)  # e.g. wrapped in a fence despite the schema
+        if not isinstance(reply, dict) or not isinstance(reply.get("verdict"), dict):
+            return {}, ""
+        if complete:
+            save_json(cached, reply)
+    next_script = strip_fences(str(reply.get("next_script") or ""))
+    if next_script and cached.exists():
+        _SCRIPT_CACHE_FILES[next_script] = cached
+    return reply["verdict"], next_script
+
+def llm_judge(output: bytes) -> dict:
+    """Try LLM-based verdict; fall back to an empty verdict on error."""
+    llm = get_llm()
+    if not llm.available:
         return {}
+    prompt = as_prompt(_JUDGE_PROMPT_B, memoryview(output)[:2000])
+    cached = llm_cache_path(llm.model, prompt, ".json")
+    if cached.exists():
+        try:
+            return loads(cached.read_bytes())
+        except Exception:
+            pass  # corrupt entry; ask again
+    # stop as soon as a complete top-level object has streamed in
+    raw, complete = llm.respond(prompt_text(prompt), temperature=0.0, max_tokens=500,
+                                stop=lambda t: t.rstrip().endswith("}") and json_object_complete(t))
+    verdict = parse_last_json_blob(raw)
+    if not isinstance(verdict, dict):
+        return {}
+    if complete:
+        save_json(cached, verdict)
+    return verdict
 
 # ----- runner / evaluation -----
-def run_script(code: str) -> tuple[int, str]:
+SCRIPT_TIMEOUT_S = 120
+
+class _ScriptTimeout(BaseException):
+    """Raised by the alarm handler; BaseException so generated `except Exception` can't swallow it."""
+
+def _alarm(signum, frame):
+    raise _ScriptTimeout()  # the timer is armed with an interval, so this repeats until disarmed
+
+def _catches_base_exception(tree: ast.AST) -> bool:
+    """True if any handler is bare `except:` or names BaseException, i.e. could swallow _ScriptTimeout."""
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.ExceptHandler):
+            continue
+        if node.type is None:
+            return True
+        types = node.type.elts if isinstance(node.type, ast.Tuple) else [node.type]
+        if any(isinstance(t, ast.Name) and t.id == "BaseException" for t in types):
+            return True
+    return False
+
+def _can_alarm() -> bool:
+    return hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+_CODE_CACHE: dict[str, tuple[CodeType, bool]] = {}  # sha256(source) -> (code object, needs hard kill)
+
+def compile_script(code: str) -> tuple[CodeType, bool]:
+    """Compile each distinct script once; the fallback is precompiled. Raises like compile().
+
+    The flag is True when the script could swallow the in-process timeout and must run in a subprocess.
+    """
+    if code == FALLBACK_SCRIPT:
+        return _FALLBACK_CODE, False
+    key = hashlib.sha256(code.encode("utf-8")).hexdigest()
+    entry = _CODE_CACHE.get(key)
+    if entry is None:
+        tree = ast.parse(code, "<generated>")
+        entry = _CODE_CACHE[key] = (compile(tree, "<generated>", "exec"), _catches_base_exception(tree))
+    return entry
+
+def run_script_subprocess(code: str) -> tuple[int, bytes]:
     """Write code to a temp file and execute it with current Python."""
     with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as f:
         f.write(code)
@@ -186,30 +472,112 @@ def run_script(code: str) -> tuple[int, str]:
     try:
         proc = subprocess.run([sys.executable, "-u", tmp],
                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                              text=True, timeout=120)
+                              timeout=SCRIPT_TIMEOUT_S)
         return proc.returncode, proc.stdout
+    except subprocess.TimeoutExpired as e:  # child was killed; report like the in-process runner
+        return -1, (e.stdout or b"") + f"timeout after {SCRIPT_TIMEOUT_S}s\n".encode("utf-8")
     finally:
         try:
             os.unlink(tmp)
         except Exception:
             pass
 
+def run_script(code: str) -> tuple[int, bytes]:
+    """Exec code in a fresh namespace in this process; stdout+stderr are captured as UTF-8 bytes.
+
+    Falls back to a subprocess, which can be killed, when the timeout can't be enforced in-process:
+    no SIGALRM / not main thread, or the script has handlers that would catch the timeout.
+    """
+    if not _can_alarm():
+        return run_script_subprocess(code)
+    try:
+        obj, needs_hard_kill = compile_script(code)
+    except SyntaxError as e:
+        return 1, "".join(traceback.format_exception_only(type(e), e)).encode("utf-8")
+    if needs_hard_kill:
+        return run_script_subprocess(code)
+    ns = {"__name__": "__main__", "__builtins__": __builtins__, "HTTP_SESSION": SESSION}
+    raw = io.BytesIO()
+    buf = io.TextIOWrapper(raw, encoding="utf-8", errors="replace", newline="", write_through=True)
+    # generated code shares our process: snapshot the state it is most likely to touch
+    cwd, environ = os.getcwd(), dict(os.environ)
+    prev = signal.signal(signal.SIGALRM, _alarm)
+    # re-fires every second past the deadline, so cleanup code can't outlive it by catching once
+    signal.setitimer(signal.ITIMER_REAL, SCRIPT_TIMEOUT_S, 1.0)
+    try:
+        with contextlib.redirect_stdout(buf), contextlib.redirect_stderr(buf):
+            try:
+                try:
+                    exec(obj, ns)
+                finally:
+                    # disarm before any handler runs; a late alarm raised here lands in the
+                    # _ScriptTimeout branch below instead of escaping run_script
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+                rc = 0
+            except SystemExit as e:  # same mapping as the interpreter's exit status
+                if e.code is None or isinstance(e.code, int):
+                    rc = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+                    rc = 1
+            except _ScriptTimeout:
+                print(f"timeout after {SCRIPT_TIMEOUT_S}s", file=sys.stderr)
+                rc = -1
+            except Exception:
+                traceback.print_exc()
+                rc = 1
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, prev)
+        os.chdir(cwd)
+        if dict(os.environ) != environ:
+            os.environ.clear()
+            os.environ.update(environ)
+    buf.flush()
+    return rc, raw.getvalue()
+
+_JSON_DECODER = json.JSONDecoder()  # stdlib: orjson has no raw_decode
+
+def json_object_complete(text: str) -> bool:
+    """True once the first '{' in text opens an object that fully decodes (for streamed replies)."""
+    i = text.find("{")
+    if i < 0:
+        return False
+    try:
+        _JSON_DECODER.raw_decode(text, i)
+        return True
+    except ValueError:
+        return False
+
 def parse_last_json_blob(text: str):
-    """Pick the last {...} block and try to parse it."""
-    matches = list(re.finditer(r"\{.*\}", text, flags=re.DOTALL))
-    if not matches:
-        return None
-    for m in reversed(matches):
+    """Return the last top-level {...} object in text.
+
+    Clients print one JSON line, so lines are tried whole from the end first; otherwise
+    raw_decode walks forward over top-level objects (skipping stray '{'), keeping the last.
+    """
+    for line in reversed(text.splitlines()):
+        line = line.strip()
+        if line.startswith("{") and line.endswith("}"):
+            try:
+                obj = loads(line)
+            except Exception:
+                continue
+            if isinstance(obj, dict):
+                return obj
+    last = None
+    i = text.find("{")
+    while i >= 0:
         try:
-            return json.loads(m.group(0))
-        except Exception:
+            last, end = _JSON_DECODER.raw_decode(text, i)
+        except ValueError:
+            i = text.find("{", i + 1)
             continue
-    return None
+        i = text.find("{", end)  # resume after the object: nested ones are never visited
+    return last
 
-def is_success_rule(output_text: str) -> tuple[bool, dict]:
+def is_success_rule(output: bytes) -> tuple[bool, dict]:
     """Rule: HTTP==200 and status_code==200."""
-    save_text(ARTIFACTS / "last_output.txt", output_text)
-    data = parse_last_json_blob(output_text) or {}
+    data = parse_last_json_blob(output.decode("utf-8", "replace")) or {}
     http_ok = (data.get("http_status") == 200)
     status_ok = (data.get("status_code") == 200)
     return (http_ok and status_ok), data
@@ -218,6 +586,8 @@ def is_success_rule(output_text: str) -> tuple[bool, dict]:
 def mask(s: str) -> str:
     return ("*"*(len(s)-4)+s[-4:]) if s and len(s) >= 4 else (s or "")
 
+MAX_ATTEMPTS = 3
+
 def main() -> None:
     # env preview (masked); helps debug without leaking secrets
     preview = {
@@ -233,33 +603,53 @@ def main() -> None:
     docs = fetch_docs(DOCS_URL)
 
     attempts = []
-    last_output = ""
-    for attempt in range(1, 4):
-        # generate client (LLM if possible, else fallback)
-        code = llm_generate_script(docs, last_output)
-
+    try:
+        # one record per attempt, appended as it happens; the .json summary is written once at the end
+        with open(ARTIFACTS / "attempts_log.jsonl", "wb") as log:
+            ok = run_attempts(docs, attempts, log)
+    finally:
+        save_json(ARTIFACTS / "attempts_log.json", attempts)
+    print("SUCCESS" if ok else "FAIL")
+
+def run_attempts(docs: bytes, attempts: list, log: BinaryIO) -> bool:
+    """Generate/run/judge up to MAX_ATTEMPTS times; log each attempt to `log`. True on success."""
+    # generate client (LLM if possible, else fallback)
+    code = llm_generate_script(docs)
+    # attempts are sequential by design: each script is generated from the previous attempt's output
+    for attempt in range(1, MAX_ATTEMPTS + 1):
         # run client
         rc, out = run_script(code)
 
-        # evaluate (try LLM, then fallback to rule)
-        verdict = llm_judge(out)
-        if isinstance(verdict, dict) and "success" in verdict:
-            ok = bool(verdict.get("success"))
-        else:
-            ok, _ = is_success_rule(out)
-
-        attempts.append({"attempt": attempt, "rc": rc, "ok": ok, "raw": out[:2000]})
-        save_json(ARTIFACTS / "attempts_log.json", attempts)
-        save_text(ARTIFACTS / "last_output.txt", out)
+        # evaluate: the cheap rule first; only when it fails ask the LLM, which may
+        # overrule it and (before a retry) also returns the fixed script for the next attempt
+        ok, _ = is_success_rule(out)
+        rule_ok, judge_ok, next_code = ok, None, ""
+        if not rule_ok:
+            if attempt < MAX_ATTEMPTS:
+                verdict, next_code = llm_judge_and_fix(docs, out, code)
+            else:
+                verdict = llm_judge(out)
+            if isinstance(verdict, dict) and "success" in verdict:
+                judge_ok = bool(verdict.get("success"))
+                ok = judge_ok
+
+        record = {"attempt": attempt, "rc": rc, "ok": ok, "rule_ok": rule_ok, "judge_ok": judge_ok,
+                  "raw": out[:2000].decode("utf-8", "replace")}
+        attempts.append(record)
+        log.write(dumps_line(record))
+        log.flush()
+        save_bytes_atomic(ARTIFACTS / "last_output.txt", out)
 
         if ok:
-            Path(ARTIFACTS / "generated_postnl_tracking.py").write_text(code, encoding="utf-8")
-            print("SUCCESS")
-            return
+            save_text(ARTIFACTS / "generated_postnl_tracking.py", code)
+            return True
+        forget_cached_script(code)  # a failing script must not be served from cache again
 
-        last_output = out  # use previous output to improve next generation
+        if attempt < MAX_ATTEMPTS:
+            # use previous output to improve next generation (plain codegen if the combined call gave none)
+            code = next_code or llm_generate_script(docs, out, code)
 
-    print("FAIL")
+    return False
 
 if __name__ == "__main__":
     main()
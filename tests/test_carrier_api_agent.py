@@ -0,0 +1,93 @@
+import importlib
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture(scope="module")
+def agent(tmp_path_factory):
+    pytest.importorskip("requests")
+    sys.path.insert(0, str(ROOT))
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("agent"))  # the module creates artifacts/ on import
+    try:
+        yield importlib.import_module("carrier_api_agent")
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(str(ROOT))
+
+
+# ----- parse_last_json_blob -----
+def test_parse_keeps_top_level_object_with_sibling_nested_objects(agent):
+    assert agent.parse_last_json_blob('{"a": {"x": 1}, "b": {"y": 2}}') == {"a": {"x": 1}, "b": {"y": 2}}
+
+
+def test_parse_realistic_client_line(agent):
+    line = (
+        '{"http_status": 200, "status_code": 200, "result": {"CurrentStatus": {"Shipment": {'
+        '"Address": [{"City": "A"}, {"City": "B"}], "Status": {"Code": "1"}}}}, "elapsed_ms": 12}'
+    )
+    ok, data = agent.is_success_rule(("log line {\n" + line + "\n").encode("utf-8"))
+    assert ok
+    assert data["result"]["CurrentStatus"]["Shipment"]["Status"] == {"Code": "1"}
+
+
+def test_parse_picks_last_of_several_top_level_objects(agent):
+    text = '{"x": 1} noise {"y": {"z": 2}, "w": {"v": 3}} trailing'
+    assert agent.parse_last_json_blob(text) == {"y": {"z": 2}, "w": {"v": 3}}
+
+
+def test_parse_skips_braces_in_strings_and_stray_braces(agent):
+    text = 'Traceback { broken\n{"a": {"b": "x}\\"{"}, "c": 1}\n'
+    assert agent.parse_last_json_blob(text) == {"a": {"b": 'x}"{'}, "c": 1}
+
+
+def test_parse_returns_none_without_object(agent):
+    assert agent.parse_last_json_blob("no json here } {") is None
+
+
+# ----- llm_judge_and_fix -----
+class FakeLLM:
+    available = True
+    model = "fake"
+
+    def __init__(self, reply):
+        self.reply = reply
+
+    def respond(self, prompt, **kwargs):
+        return self.reply, True
+
+
+def test_judge_and_fix_keeps_script_containing_json_literals(agent, monkeypatch, tmp_path):
+    reply = agent.dumps({
+        "verdict": {"success": False, "reasons": ["401"], "patch_hint": "send apikey"},
+        "next_script": 'params = {}\nprint({"a": 1})',
+    }).decode("utf-8")
+    monkeypatch.setattr(agent, "LLM_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(agent, "get_llm", lambda: FakeLLM(reply))
+    verdict, script = agent.llm_judge_and_fix(b"docs", b'{"http_status": 401}', "old script")
+    assert verdict == {"success": False, "reasons": ["401"], "patch_hint": "send apikey"}
+    assert script == 'params = {}\nprint({"a": 1})'
+
+
+# ----- run_script -----
+def test_run_script_restores_cwd_and_environ(agent, tmp_path):
+    cwd = os.getcwd()
+    code = (
+        "import os\n"
+        f"os.chdir({str(tmp_path)!r})\n"
+        "os.environ['CARRIER_AGENT_TEST'] = '1'\n"
+        "os.environ.pop('PATH', None)\n"
+        "print('done')\n"
+    )
+    path = os.environ.get("PATH")
+    rc, out = agent.run_script(code)
+    assert (rc, out) == (0, b"done\n")
+    assert os.getcwd() == cwd
+    assert "CARRIER_AGENT_TEST" not in os.environ
+    assert os.environ.get("PATH") == path
+    assert agent.ARTIFACTS.is_absolute()